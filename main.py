@@ -31,6 +31,8 @@ class Experiment:
         batch_size: int = 256,
         learning_rate: float = 2e-5,
         warmup_steps: int = 1000,
+        accum_steps: int = 1,
+        log_every: int = 50,
         train_datasets: list = ["snli", "mnli"],
         validation_datasets: list = ["stsb"],
         include_baseline=False,
@@ -51,6 +53,12 @@ class Experiment:
         self.num_epochs = num_epochs
         self.learning_rate = learning_rate
         self.warmup_steps = warmup_steps
+        if accum_steps < 1:
+            raise ValueError(f"accum_steps must be at least 1, got {accum_steps}.")
+        self.accum_steps = accum_steps
+        if log_every < 1:
+            raise ValueError(f"log_every must be at least 1, got {log_every}.")
+        self.log_every = log_every
         self.train_datasets = train_datasets
         self.validation_datasets = validation_datasets
         self.include_baseline = include_baseline
@@ -181,6 +189,8 @@ def run_benchmark(args):
                 batch_size=256,
                 learning_rate=2e-5,
                 warmup_steps=args.warmup_steps,
+                accum_steps=args.accum_steps,
+                log_every=args.log_every,
                 train_datasets=[dataset],
                 validation_datasets=[dataset],
                 include_baseline=args.include_baseline,
@@ -225,6 +235,18 @@ def main():
     parser.add_argument(
         "--warmup-steps", type=int, default=1000, help="Number of warmup steps."
     )
+    parser.add_argument(
+        "--accum-steps",
+        type=int,
+        default=1,
+        help="Number of batches to accumulate gradients over per optimizer step.",
+    )
+    parser.add_argument(
+        "--log-every",
+        type=int,
+        default=50,
+        help="Number of steps between train loss logs.",
+    )
     parser.add_argument(
         "--train-datasets",
         nargs="+",
@@ -283,6 +305,8 @@ def main():
                 batch_size=args.batch_size,
                 learning_rate=args.learning_rate,
                 warmup_steps=args.warmup_steps,
+                accum_steps=args.accum_steps,
+                log_every=args.log_every,
                 train_datasets=args.train_datasets,
                 validation_datasets=args.validation_datasets,
                 include_baseline=args.include_baseline,
@@ -6,9 +6,10 @@ import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import f1_score, matthews_corrcoef, precision_score
 
+from src.utils import get_amp_dtype
+
 
 class GLUEWrapper(nn.Module):
 
@@ -89,22 +90,14 @@ class GLUEWrapper(nn.Module):
         ground_truth: torch.Tensor,
     ) -> torch.Tensor:
 
-        similarities = cosine_sim(sentence1, sentence2).diagonal()
+        similarities = F.cosine_similarity(sentence1, sentence2, dim=-1)
         predicted_correlation = pearson_r(similarities, ground_truth)
         return 1 - predicted_correlation
 
     def correlation_predictions(self, batch: torch.Tensor) -> torch.Tensor:
         sentence1 = self.model(input_ids=batch[0], attention_mask=batch[1])[1]
         sentence2 = self.model(input_ids=batch[2], attention_mask=batch[3])[1]
-        return cosine_sim(sentence1, sentence2).diagonal()
-
-
-def cosine_sim(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
-    dot_product = torch.einsum("ij,kj->ik", a, b)
-    norm_a = torch.sqrt(torch.einsum("ij,ij->i", a, a))
-    norm_b = torch.sqrt(torch.einsum("ij,ij->i", b, b))
-    norm_product = torch.einsum("i,j->ij", norm_a, norm_b)
-    return dot_product / norm_product
+        return F.cosine_similarity(sentence1, sentence2, dim=-1)
 
 
 def pearson_r(x: torch.Tensor, y: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
@@ -119,6 +112,20 @@ def pearson_r(x: torch.Tensor, y: torch.Tensor, eps: float = 1e-8) -> torch.Tens
     return numerator / (denominator + eps)
 
 
+def rank_data(x: torch.Tensor) -> torch.Tensor:
+    """
+    Average ranks (1-based) of a 1-D tensor, with ties sharing their mean rank.
+    """
+    _, inverse, counts = torch.unique(x, return_inverse=True, return_counts=True)
+    ends = torch.cumsum(counts, dim=0)
+    average_ranks = ends.float() - (counts.float() - 1) / 2
+    return average_ranks[inverse]
+
+
+def spearman_r(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return pearson_r(rank_data(x.float()), rank_data(y.float()))
+
+
 GLUE_LABEL_MAPS = {
     "cola": {0: "unacceptable", 1: "acceptable"},
     "sst2": {0: "negative", 1: "positive"},
@@ -153,8 +160,10 @@ def evaluate(
     Otherwise, evaluates on the 'validation' set and returns metrics (accuracy, precision, f1, mcc).
     For STS-B, returns the Spearman correlation using the spearman_evaluate function above.
     """
-    model.to(device)
+    # The model is expected to already live on `device`; its mode is restored below
+    was_training = model.training
     model.eval()
+    amp_dtype = get_amp_dtype()
 
     if test:
         # ====================
@@ -168,13 +177,13 @@ def evaluate(
         model.load_state_dict(state_dict)
 
         with torch.no_grad():
-            with torch.autocast(device_type="cuda", dtype=torch.float16):
+            with torch.autocast(device_type="cuda", dtype=amp_dtype):
                 for batch in data_loader[dataset_name]["test"]:
-                    batch = [x.to(device) for x in batch]
-                    preds = model.get_predictions(batch).cpu().numpy()
-                    all_predictions.append(preds)
+                    batch = [x.to(device, non_blocking=True) for x in batch]
+                    all_predictions.append(model.get_predictions(batch))
 
-        all_predictions = np.concatenate(all_predictions, axis=0)
+        model.train(was_training)
+        all_predictions = torch.cat(all_predictions).cpu().numpy()
 
         if glue_submission:
             label_map = GLUE_LABEL_MAPS.get(dataset_name, None)
@@ -212,26 +221,37 @@ def evaluate(
     # =====================
     # Evaluation on Val
     # =====================
-    all_preds = []
-    all_labels = []
+    val_loader = data_loader[dataset_name]["validation"]
+    # Preallocated on device and filled per batch; the loader may drop its last batch
+    num_samples = len(val_loader.dataset)
+    all_preds = None
+    all_labels = torch.empty(num_samples, dtype=torch.long, device=device)
+    offset = 0
 
     with torch.no_grad():
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            for batch in data_loader[dataset_name]["validation"]:
+        with torch.autocast(device_type="cuda", dtype=amp_dtype):
+            for batch in val_loader:
 
-                batch = [x.to(device) for x in batch]
+                batch = [x.to(device, non_blocking=True) for x in batch]
                 preds = model.get_predictions(batch)
                 labels = batch[-1].long()
 
-                all_preds.append(preds.cpu())
-                all_labels.append(labels.cpu())
+                if all_preds is None:
+                    all_preds = preds.new_empty(num_samples)
+                all_preds[offset : offset + len(preds)] = preds
+                all_labels[offset : offset + len(labels)] = labels
+                offset += len(labels)
 
-    all_preds = torch.cat(all_preds).numpy()
-    all_labels = torch.cat(all_labels).numpy()
+    model.train(was_training)
+    all_preds = all_preds[:offset]
+    all_labels = all_labels[:offset]
 
     if dataset_name == "stsb":
         return spearman_evaluate(all_preds, all_labels)
 
+    all_preds = all_preds.cpu().numpy()
+    all_labels = all_labels.cpu().numpy()
+
     num_classes = len(np.unique(all_labels))
     avg_type = "macro"
 
@@ -244,11 +264,12 @@ def evaluate(
 
 
 def spearman_evaluate(
-    similarities: np.array,
-    labels: np.array,
+    similarities: torch.Tensor,
+    labels: torch.Tensor,
 ) -> Optional[Dict[str, float]]:
 
-    eval_pearson_cosine, _ = pearsonr(similarities, labels)
-    eval_spearman_cosine, _ = spearmanr(similarities, labels)
+    # Computed on the device the tensors live on; only the two scalars are synced.
+    eval_pearson_cosine = pearson_r(similarities, labels).item()
+    eval_spearman_cosine = spearman_r(similarities, labels).item()
 
     return {"pearsonr": eval_pearson_cosine, "spearmanr": eval_spearman_cosine}
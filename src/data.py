@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 
@@ -32,6 +33,26 @@ def filter_entailment(ds_split, label_key, entailment_value):
     return ds_split.select(filtered_indices)
 
 
+def default_num_workers(world_size: int = 1) -> int:
+    """
+    Number of DataLoader workers per process, sharing the CPU cores between ranks.
+    """
+    # Respect affinity/cgroup limits where the platform exposes them
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    cpus_per_rank = num_cpus // max(1, world_size)
+    return max(1, min(cpus_per_rank - 1, 8))
+
+
+def loader_worker_kwargs(num_workers: int) -> Dict:
+    # persistent_workers/prefetch_factor are only valid with worker processes
+    if num_workers == 0:
+        return {}
+    return {"persistent_workers": True, "prefetch_factor": 4}
+
+
 def create_dataloader(
     tokenizer,
     ds_split,
@@ -40,6 +61,7 @@ def create_dataloader(
     sentence1_key="sentence1",
     sentence2_key=None,
     label_key=None,
+    num_workers=0,
 ):
     sentences1 = ds_split[sentence1_key]
     encodings1 = tokenize_texts(sentences1, tokenizer, max_length)
@@ -67,7 +89,13 @@ def create_dataloader(
 
     dataset = TensorDataset(*tensors)
     dataloader = DataLoader(
-        dataset, batch_size=batch_size, shuffle=True, drop_last=True
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        drop_last=True,
+        pin_memory=True,
+        num_workers=num_workers,
+        **loader_worker_kwargs(num_workers),
     )
     return dataloader
 
@@ -94,6 +122,7 @@ class GlueDatasetLoader:
     tokenizer: PreTrainedTokenizer = None
     max_length: int = None
     batch_size: int = None
+    num_workers: Optional[int] = None
     datasets: Dict[str, DatasetDict] = field(init=False, default_factory=dict)
     data_loaders: Dict[str, Dict[str, DataLoader]] = field(
         init=False, default_factory=dict
@@ -198,6 +227,13 @@ class GlueDatasetLoader:
                     )
                     continue  # Skip creating DataLoader for this split
 
+                # Only the train loaders get a (persistent) worker pool
+                num_workers = 0
+                if split == "train":
+                    num_workers = self.num_workers
+                    if num_workers is None:
+                        num_workers = default_num_workers()
+
                 dataloader = create_dataloader(
                     tokenizer=self.tokenizer,
                     ds_split=ds_split,
@@ -206,6 +242,7 @@ class GlueDatasetLoader:
                     sentence1_key=sentence1_key,
                     sentence2_key=sentence2_key,
                     label_key=label_key,
+                    num_workers=num_workers,
                 )
                 self.data_loaders[name][split] = dataloader
                 print(
@@ -1,3 +1,5 @@
+import contextlib
+import math
 import os
 from typing import Dict, List, Optional
 
@@ -9,9 +11,10 @@ import torch.nn.functional as F
 from torch.cuda.amp import GradScaler
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from transformers import get_linear_schedule_with_warmup
 
 from src.benchmark import evaluate
+from src.data import default_num_workers, loader_worker_kwargs
+from src.utils import get_amp_dtype
 
 
 def initialize_writer(name: str, is_master: bool) -> Optional[SummaryWriter]:
@@ -26,19 +29,121 @@ def save_best_model(embedder: torch.nn.Module, name: str):
     print(f"New best model saved to weights/{name}.pt")
 
 
+class LinearWarmupScheduler:
+    """
+    Linear warmup followed by linear decay to zero, matching
+    transformers.get_linear_schedule_with_warmup, with every step's learning-rate
+    factor precomputed so step() is a table lookup.
+    """
+
+    def __init__(self, optimizer, warmup_steps: int, total_steps: int):
+        self.optimizer = optimizer
+        self.base_lrs = [group["lr"] for group in optimizer.param_groups]
+        self.lr_factors = [
+            step / max(1, warmup_steps)
+            if step < warmup_steps
+            else max(0.0, (total_steps - step) / max(1, total_steps - warmup_steps))
+            for step in range(total_steps + 1)
+        ]
+        self.last_step = 0
+        self.set_lr()
+
+    def set_lr(self):
+        factor = self.lr_factors[min(self.last_step, len(self.lr_factors) - 1)]
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group["lr"] = base_lr * factor
+
+    def step(self):
+        self.last_step += 1
+        self.set_lr()
+
+
 def setup_scheduler(optimizer, warmup_steps: int, total_steps: int):
-    return get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps=warmup_steps, num_training_steps=total_steps
-    )
+    return LinearWarmupScheduler(optimizer, warmup_steps, total_steps)
+
+
+def setup_backends():
+    # Batches are padded to a fixed length, so cuDNN autotuning pays off,
+    # and TF32 covers the FP32 matmuls that autocast leaves alone.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
+
+def compile_model(embedder: torch.nn.Module) -> torch.nn.Module:
+    # torch.compile only exists from torch 2.0; older installs train eagerly
+    if not hasattr(torch, "compile"):
+        return embedder
+    return torch.compile(embedder, mode="reduce-overhead", fullgraph=False)
 
 
-def setup_scaler() -> GradScaler:
+def unwrap_model(embedder: torch.nn.Module) -> torch.nn.Module:
+    """
+    Strip the DDP and torch.compile wrappers, e.g. for saving or evaluation.
+    """
+    if isinstance(embedder, torch.nn.parallel.DistributedDataParallel):
+        embedder = embedder.module
+    return getattr(embedder, "_orig_mod", embedder)
+
+
+def enable_fused_optimizer(optimizer: torch.optim.Optimizer):
+    """
+    Switch Adam/AdamW to the fused CUDA update, or to the multi-tensor (foreach)
+    update where this torch version has no fused implementation.
+    Must run before the first optimizer step.
+    """
+    if not isinstance(optimizer, (torch.optim.Adam, torch.optim.AdamW)):
+        return
+
+    supports_fused = "fused" in optimizer.defaults
+    for group in optimizer.param_groups:
+        if supports_fused and all(p.is_cuda for p in group["params"]):
+            group["fused"] = True
+            group["foreach"] = False
+        elif "foreach" in group:
+            group["foreach"] = True
+
+
+def setup_scaler(enabled: bool = True) -> GradScaler:
     return GradScaler(
         init_scale=2.0**16,  # Initial scale (default: 2^16)
         growth_factor=2.0,  # Factor to increase the scale (default: 2.0)
         backoff_factor=0.5,  # Factor to decrease the scale (default: 0.5)
         growth_interval=2000,  # Steps before increasing the scale (default: 2000)
-        enabled=True,  # Enable or disable the scaler (default: True)
+        enabled=enabled,  # Enable or disable the scaler (default: True)
+    )
+
+
+def setup_val_loader(
+    data, dataset_name: str, is_ddp: bool, world_size: int, rank: int
+) -> Optional[DataLoader]:
+    val_split_keys = [
+        key for key in data.data_loaders[dataset_name].keys() if "validation" in key
+    ]
+    if not val_split_keys:
+        return None
+
+    val_loader = data.data_loaders[dataset_name][val_split_keys[0]]
+    if not is_ddp:
+        return val_loader
+
+    # Too few batches per rank to be worth sharding: validate on rank 0 only
+    if len(val_loader.dataset) < world_size * val_loader.batch_size * 4:
+        return val_loader if rank == 0 else None
+
+    val_sampler = DistributedSampler(
+        val_loader.dataset,
+        num_replicas=world_size,
+        rank=rank,
+        shuffle=False,
+    )
+    return DataLoader(
+        val_loader.dataset,
+        batch_size=val_loader.batch_size,
+        sampler=val_sampler,
+        num_workers=val_loader.num_workers,
+        pin_memory=True,
     )
 
 
@@ -67,19 +172,33 @@ def train_loop(
     dataset_names = experiment.train_datasets
     num_epochs = experiment.num_epochs
     warmup_steps = experiment.warmup_steps
+    accum_steps = experiment.accum_steps
+    log_every = experiment.log_every
 
     embedder.to(device)
+    enable_fused_optimizer(optimizer)
 
-    # Calculate total steps
-    total_steps_per_epoch = sum(
-        len(data.data_loaders[dataset_name]["train"])
+    # Calculate total steps, caching the loader lengths for the per-epoch averages
+    train_lengths = {
+        dataset_name: len(data.data_loaders[dataset_name]["train"])
         for dataset_name in dataset_names
         if "train" in data.data_loaders[dataset_name]
+    }
+    total_steps_per_epoch = sum(
+        math.ceil(length / accum_steps) for length in train_lengths.values()
     )
     total_steps = total_steps_per_epoch * num_epochs
 
     scheduler = setup_scheduler(optimizer, warmup_steps, total_steps)
-    scaler = setup_scaler()
+    # Loss scaling is only needed for FP16; with BF16 the scaler calls are no-ops
+    amp_dtype = get_amp_dtype()
+    scaler = setup_scaler(enabled=amp_dtype == torch.float16)
+
+    # The validation splits are fixed, so shard them once for all epochs
+    val_loaders = {
+        dataset_name: setup_val_loader(data, dataset_name, is_ddp, world_size, rank)
+        for dataset_name in dataset_names
+    }
 
     global_step = 0
     best_stsb_score = -float("inf")
@@ -90,53 +209,45 @@ def train_loop(
 
         for dataset_name in dataset_names:
             embedder.train()
-            total_train_loss = 0.0
+            # Accumulated on device so the loss is only synced once per epoch
+            total_train_loss = torch.zeros((), device=device)
             train_loader = data.data_loaders[dataset_name]["train"]
 
             if is_ddp:
                 train_loader.sampler.set_epoch(epoch)
 
-            val_split_keys = [
-                key
-                for key in data.data_loaders[dataset_name].keys()
-                if "validation" in key
-            ]
-            val_loader = None
-            if val_split_keys:
-                val_loader_key = val_split_keys[0]
-                val_loader = data.data_loaders[dataset_name][val_loader_key]
-                if is_ddp:
-                    val_sampler = DistributedSampler(
-                        val_loader.dataset,
-                        num_replicas=world_size,
-                        rank=rank,
-                        shuffle=False,
-                    )
-                    val_loader = DataLoader(
-                        val_loader.dataset,
-                        batch_size=val_loader.batch_size,
-                        sampler=val_sampler,
-                        num_workers=val_loader.num_workers,
-                        pin_memory=True,
-                    )
+            val_loader = val_loaders[dataset_name]
 
-            for batch in train_loader:
-                batch = tuple(t.to(device) for t in batch)
-                # optimizer.zero_grad()
+            for step, batch in enumerate(train_loader):
+                batch = tuple(t.to(device, non_blocking=True) for t in batch)
+                is_update_step = (step + 1) % accum_steps == 0 or (
+                    step + 1 == train_lengths[dataset_name]
+                )
 
-                with torch.autocast(device_type="cuda", dtype=torch.float16):
-                    train_loss = embedder(batch)
+                # Skip the DDP allreduce on micro-steps that only accumulate
+                if is_ddp and not is_update_step:
+                    sync_context = embedder.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
 
-                scaler.scale(train_loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-                scheduler.step()
-                optimizer.zero_grad()
+                with sync_context:
+                    with torch.autocast(device_type="cuda", dtype=amp_dtype):
+                        train_loss = embedder(batch)
 
-                total_train_loss += train_loss.item()
+                    scaler.scale(train_loss / accum_steps).backward()
+
+                if is_update_step:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    scheduler.step()
+                    # Under DDP the grads are views into the allreduce buckets;
+                    # zero them in place so the views survive between steps
+                    optimizer.zero_grad(set_to_none=not is_ddp)
+
+                total_train_loss += train_loss.detach()
                 global_step += 1
 
-                if writer and rank == 0:
+                if writer and rank == 0 and global_step % log_every == 0:
                     log_metrics(
                         writer,
                         dataset_name,
@@ -145,20 +256,32 @@ def train_loop(
                         global_step,
                     )
 
-            avg_train_loss = total_train_loss / len(train_loader)
+            avg_train_loss = total_train_loss.item() / train_lengths[dataset_name]
 
             if val_loader is not None:
-                embedder.eval()
-                total_val_loss = 0.0
+                is_sharded = isinstance(val_loader.sampler, DistributedSampler)
+                # Bypass DDP (no collectives on a rank-0-only pass) and the
+                # compiled graph (no eval-mode recompiles on ragged batches)
+                val_model = unwrap_model(embedder)
+                val_model.eval()
+                total_val_loss = torch.zeros((), device=device)
+                num_val_batches = len(val_loader)
 
                 with torch.no_grad():
-                    with torch.autocast(device_type="cuda", dtype=torch.float16):
+                    with torch.autocast(device_type="cuda", dtype=amp_dtype):
                         for batch in val_loader:
-                            batch = tuple(t.to(device) for t in batch)
-                            val_loss = embedder(batch)
-                            total_val_loss += val_loss.item()
+                            batch = tuple(
+                                t.to(device, non_blocking=True) for t in batch
+                            )
+                            val_loss = val_model(batch)
+                            total_val_loss += val_loss.float()
 
-                avg_val_loss = total_val_loss / (len(val_loader) + 1e-6)
+                if is_sharded:
+                    # Every rank sees the same number of batches from its sampler
+                    dist.all_reduce(total_val_loss, op=dist.ReduceOp.SUM)
+                    num_val_batches *= world_size
+
+                avg_val_loss = total_val_loss.item() / (num_val_batches + 1e-6)
 
                 if writer and rank == 0:
                     print(
@@ -175,33 +298,34 @@ def train_loop(
                         f"No validation data for {dataset_name}."
                     )
 
-            if writer and rank == 0:
-                # For DDP, use the underlying model
-                model_to_evaluate = embedder.module if is_ddp else embedder
+        # Benchmark once per epoch rather than after every training dataset
+        if writer and rank == 0:
+            # For DDP or compiled models, use the underlying model
+            model_to_evaluate = unwrap_model(embedder)
+            values = []
+            for eval_name in experiment.validation_datasets:
                 results = evaluate(
-                    model_to_evaluate, data.data_loaders, device, dataset_name, name
+                    model_to_evaluate, data.data_loaders, device, eval_name, name
                 )
-                print(f"{dataset_name} Validation: {results}")
+                print(f"{eval_name} Validation: {results}")
 
                 for metric, score in results.items():
-                    log_metrics(writer, dataset_name, metric, score, global_step)
+                    log_metrics(writer, eval_name, metric, score, global_step)
+
+                values.extend(results.values())
 
-                values = list(results.values())
-                current_stsb_score = sum(values) / len(values)
+            current_stsb_score = sum(values) / len(values)
 
-                if current_stsb_score > best_stsb_score:
-                    best_stsb_score = current_stsb_score
-                    if is_ddp:
-                        save_best_model(embedder.module, name)
-                    else:
-                        save_best_model(embedder, name)
+            if current_stsb_score > best_stsb_score:
+                best_stsb_score = current_stsb_score
+                save_best_model(model_to_evaluate, name)
 
         if rank == 0:
             print("")
 
     if writer and rank == 0:
-        # For DDP, use the underlying model
-        model_to_evaluate = embedder.module if is_ddp else embedder
+        # For DDP or compiled models, use the underlying model
+        model_to_evaluate = unwrap_model(embedder)
         evaluate(
             model_to_evaluate, data.data_loaders, device, dataset_name, name, test=True
         )
@@ -215,9 +339,13 @@ def train(
     """
     Single-GPU training function.
     """
+    setup_backends()
     device = experiment.device
     writer = initialize_writer(name, is_master=True)
 
+    embedder.to(device)
+    embedder = compile_model(embedder)
+
     embedder = train_loop(
         embedder=embedder,
         optimizer=optimizer,
@@ -231,7 +359,7 @@ def train(
     if writer:
         writer.close()
 
-    return embedder
+    return unwrap_model(embedder)
 
 
 def train_worker(
@@ -246,6 +374,7 @@ def train_worker(
     """
     Distributed training worker function.
     """
+    setup_backends()
     os.environ["MASTER_ADDR"] = "localhost"
     os.environ["MASTER_PORT"] = "9999"  # Choose any free port
 
@@ -254,7 +383,17 @@ def train_worker(
     device = torch.device(f"cuda:{rank}")
 
     embedder.to(device)
-    embedder = torch.nn.parallel.DistributedDataParallel(embedder, device_ids=[rank])
+    # Compile before wrapping so Dynamo traces the plain module
+    embedder = compile_model(embedder)
+    # The set of used parameters is the same on every step, so the graph is
+    # static, and the allreduce buckets can alias the gradients directly.
+    embedder = torch.nn.parallel.DistributedDataParallel(
+        embedder,
+        device_ids=[rank],
+        bucket_cap_mb=50,
+        gradient_as_bucket_view=True,
+        static_graph=True,
+    )
 
     is_master = rank == 0
     writer = initialize_writer(name, is_master)
@@ -262,6 +401,10 @@ def train_worker(
     if is_master:
         os.makedirs("weights", exist_ok=True)
 
+    num_workers = default_num_workers(world_size)
+    if is_master:
+        print(f"Using {num_workers} DataLoader workers per rank.")
+
     data = experiment.data
     for dataset_name in experiment.train_datasets:
         train_loader = data.data_loaders[dataset_name]["train"]
@@ -272,8 +415,9 @@ def train_worker(
             train_loader.dataset,
             batch_size=train_loader.batch_size,
             sampler=train_sampler,
-            num_workers=train_loader.num_workers,
+            num_workers=num_workers,
             pin_memory=True,
+            **loader_worker_kwargs(num_workers),
         )
 
     embedder = train_loop(
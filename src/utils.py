@@ -1,9 +1,21 @@
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 
 import torch
 
 
+@lru_cache(maxsize=None)
+def get_amp_dtype() -> torch.dtype:
+    """
+    Autocast dtype: BF16 where the GPU supports it (no loss scaling needed),
+    otherwise FP16, which trains with a GradScaler.
+    """
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
 @contextmanager
 def timer(name="Task"):
     """A context manager to measure execution time."""